@@ -2,26 +2,32 @@ import logging
 import time
 from datetime import datetime, timedelta
 import requests
-from plexapi.exceptions import BadRequest
+import requests_cache
+from requests.adapters import HTTPAdapter
 from plexapi.myplex import MyPlexAccount
-from plexapi.server import PlexServer
+import functools
+import itertools
 import re, unicodedata
-from difflib import SequenceMatcher
-from logging.handlers import TimedRotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rapidfuzz import fuzz, process
+from logging.handlers import MemoryHandler, TimedRotatingFileHandler
 from dotenv import load_dotenv
 import os
 
 # --- 1. CONFIGURATION ---
 EXCLUDED_LANGS = {"ko", "zh"}
 EXCLUDED_COUNTRIES = {"KR", "CN", "TW", "HK"}
+HTTP_WORKERS = 8  # concurrent TMDb fetches, Plex Discover searches and watchlist additions
 
 load_dotenv()  # load .env
 
 API_KEY = os.getenv("TMDB_API_KEY")
-MOVIE_URL = f"https://api.themoviedb.org/3/trending/movie/week?api_key={API_KEY}"
-TV_URL = f"https://api.themoviedb.org/3/trending/tv/week?api_key={API_KEY}"
+TMDB_ACCESS_TOKEN = os.getenv("TMDB_ACCESS_TOKEN")  # v4 read access token; preferred over API_KEY
+MOVIE_URL = "https://api.themoviedb.org/3/trending/movie/week"
+TV_URL = "https://api.themoviedb.org/3/trending/tv/week"
+
+CACHE_DIR = os.path.expanduser(os.getenv("CACHE_DIR", "~/.cache/plex_dynamic_watchlist"))
 
-PLEX_BASEURL = os.getenv("PLEX_BASEURL", "http://192.168.68.100:32400")
 PLEX_TOKEN = os.getenv("PLEX_TOKEN")
 
 LOG_FILE_PATH = os.getenv("LOG_FILE_PATH", "/scripts/arr/dynamic_watchlist.log")
@@ -36,18 +42,37 @@ stream_handler.setFormatter(log_formatter)
 logger.addHandler(stream_handler)
 
 # Handler for writing to the file
+buffered_file_handler = None
 try:
     file_handler = TimedRotatingFileHandler(
         LOG_FILE_PATH, when='midnight', interval=1, backupCount=7
     )
     file_handler.setFormatter(log_formatter)
-    logger.addHandler(file_handler)
+    # Buffer records and write them in batches; ERROR and above are flushed immediately,
+    # and the rest at the end of every dynamic_watchlist() run.
+    buffered_file_handler = MemoryHandler(capacity=64, target=file_handler)
+    logger.addHandler(buffered_file_handler)
     logger.info(f"File logging enabled to: {LOG_FILE_PATH}")
 except PermissionError:
     logger.warning(f"Permission denied to write to '{LOG_FILE_PATH}'. File logging is disabled.")
 except Exception as e:
     logger.warning(f"An unexpected error occurred while setting up file logging: {e}. File logging is disabled.")
 
+# Pooled, keep-alive session for TMDb; responses are cached on disk for an hour.
+# Once expired, entries are revalidated with If-None-Match / If-Modified-Since, so an
+# unchanged trending list costs a 304 rather than a full download.
+# requests_cache leaves api_key / Authorization out of its cache keys.
+try:
+    SESSION = requests_cache.CachedSession(
+        os.path.join(CACHE_DIR, 'tmdb_cache'), backend='sqlite', expire_after=3600
+    )
+except Exception as e:
+    logger.warning(f"Could not open TMDb cache in '{CACHE_DIR}': {e}. Response caching is disabled.")
+    SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+if TMDB_ACCESS_TOKEN:
+    SESSION.headers['Authorization'] = f"Bearer {TMDB_ACCESS_TOKEN}"
+
 def is_excluded_tmdb_item(item: dict) -> bool:
     # Language-based exclusion (movies + TV)
     lang = item.get("original_language")
@@ -61,39 +86,41 @@ def is_excluded_tmdb_item(item: dict) -> bool:
 
     return False
 
+_NONALNUM_RE = re.compile(r'[^a-z0-9]+')
+_YEAR_RE = re.compile(r'(\d{4})')
+_TMDB_GUID_RE = re.compile(r'tmdb://(\d+)')
+
+@functools.lru_cache(maxsize=4096)
 def norm_title(s: str) -> str:
     if not s: return ""
     s = unicodedata.normalize('NFKD', s)
     s = ''.join(c for c in s if not unicodedata.combining(c))
-    s = re.sub(r'[^a-z0-9]+', ' ', s.lower())
+    s = _NONALNUM_RE.sub(' ', s.lower())
     return s.strip()
 
-def similar(a: str, b: str) -> float:
-    return SequenceMatcher(None, norm_title(a), norm_title(b)).ratio()
-
 def year_from(date_str: str) -> int | None:
     if not date_str: return None
-    m = re.match(r'(\d{4})', date_str)
+    m = _YEAR_RE.match(date_str)
     return int(m.group(1)) if m else None
 
 def tmdb_id_from_guids(plex_obj) -> int | None:
     # plex_obj.guids is a list of Guid objects or strings like 'tmdb://12345?lang=en'
     for g in getattr(plex_obj, 'guids', []) or []:
         gid = getattr(g, 'id', g)  # Guid.id or raw string
-        m = re.search(r'tmdb://(\d+)', str(gid))
+        m = _TMDB_GUID_RE.search(str(gid))
         if m:
             return int(m.group(1))
     return None
 
-def titles_from_tmdb_item(item: dict) -> list[str]:
-    # De-duped title candidates from TMDb payload
+def titles_from_tmdb_item(item: dict) -> tuple[list[str], set[str]]:
+    # De-duped title candidates from TMDb payload, plus their normalized forms
     cand = [item.get(k) for k in ('name','original_name','title','original_title') if item.get(k)]
     seen, out = set(), []
     for t in cand:
         nt = norm_title(t)
         if nt and nt not in seen:
             seen.add(nt); out.append(t)
-    return out
+    return out, seen
 
 def watchlist_signatures(account, libtype: str):
     """Return (tmdb_ids_in_watchlist, (norm_title, year) pairs) for quick membership tests."""
@@ -109,94 +136,174 @@ def watchlist_signatures(account, libtype: str):
         logger.warning(f"Failed to read watchlist for '{libtype}': {e}")
     return tmdb_ids, title_years
 
-def discover_best_match(account, media_type: str, titles: list[str], year: int | None, tmdb_id: int | None):
+# media_type -> (tmdb_ids_in_watchlist, (norm_title, year) pairs)
+WatchlistCache = dict[str, tuple[set[int], set[tuple[str, int]]]]
+
+def watchlist_cache(account, executor) -> WatchlistCache:
+    """
+    Fetch movie and show watchlist signatures once per run, concurrently on `executor`.
+    Not memoized: each run logs in with a fresh account and then adds to the watchlist,
+    so a cached copy would never be reused and could only go stale.
+    """
+    libtypes = ('movie', 'show')
+    signatures = executor.map(lambda lt: watchlist_signatures(account, lt), libtypes)
+    return dict(zip(libtypes, signatures))
+
+@functools.lru_cache(maxsize=512)
+def _discover(account, query: str, libtype: str) -> tuple:
+    """Memoized account.searchDiscover; cleared at the end of each run by dynamic_watchlist()."""
+    return tuple(account.searchDiscover(query=query, libtype=libtype) or [])
+
+def _result_tmdb_id(plex_obj) -> int | None:
+    """
+    tmdb_id_from_guids, memoized on the object as `_cached_tmdb_id`.
+    Discover results arrive without GUIDs, so the first read of `.guids` makes plexapi
+    reload the item; read lazily so the GUID scan can still stop at the first hit.
+    """
+    try:
+        return plex_obj._cached_tmdb_id
+    except AttributeError:
+        plex_obj._cached_tmdb_id = tmdb_id_from_guids(plex_obj)
+        return plex_obj._cached_tmdb_id
+
+def discover_best_match(account, executor, media_type: str, titles: list[str], year: int | None, tmdb_id: int | None):
     """
     Use Plex Discover to find the exact item to add.
+    All candidate queries are issued concurrently on `executor`; searches that have not
+    started yet are cancelled once a match is returned.
     Preference order:
     1) result whose guids include tmdb://<id>
     2) title-year match (±1 year) with high similarity
     3) otherwise the first sane result
+    A fuzzy match is only accepted early once the tmdb:// lookup has finished, so a strong
+    title match cannot pre-empt the GUID lookup itself. An exact GUID hit found in a title
+    query can still lose to a strong fuzzy match from an earlier query that answers first.
     """
-    guid = f"tmdb://{tmdb_id}"
-    try:
-        plex_items = account.searchDiscover(guid, libtype=media_type)
-        if plex_items and plex_items[0]:
-            logger.debug(f"Matched via TMDB GUID: {plex_item.title} ({plex_item.year})")
-            return plex_items[0]
-    except Exception as e:
-        logger.debug(f"No match via GUID {guid}: {e}")
-
-    queries = []
+    guid_query = f"tmdb://{tmdb_id}" if tmdb_id is not None else None
+    queries = [guid_query] if guid_query else []
     for t in titles:
         if year: queries.append(f"{t} {year}")
         queries.append(t)
 
-
+    futures = {executor.submit(_discover, account, q, media_type): i for i, q in enumerate(queries)}
+    completed, next_idx = {}, 0
+    guid_done = guid_query is None
     best_by_similarity = (None, 0.0)
-    for q in queries:
-        try:
-            results = account.searchDiscover(query=q, libtype=media_type) or []
-        except Exception as e:
-            logger.debug(f"Discover search failed for '{q}': {e}")
-            continue
-
-        # 1) Exact TMDb GUID match
-        if tmdb_id:
-            for r in results:
-                rid = tmdb_id_from_guids(r)
-                if rid and rid == tmdb_id:
-                    return r
-
-        # 2) Year + fuzzy title
-        filtered = []
-        if year:
-            for r in results:
-                ry = getattr(r, 'year', None)
-                if isinstance(ry, int) and abs(ry - year) <= 1:
-                    filtered.append(r)
-        ranked = filtered or results
-
-        # keep the most similar title as a fallback candidate
-        for r in ranked:
-            sim = similar(getattr(r, 'title', ''), titles[0])
-            if sim > best_by_similarity[1]:
-                best_by_similarity = (r, sim)
-
-        # If we have a very strong match, take it
-        if best_by_similarity[0] and best_by_similarity[1] >= 0.92:
-            return best_by_similarity[0]
+    try:
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results = future.result() or []
+            except Exception as e:
+                logger.debug("Discover search failed for '%s': %s", queries[i], e)
+                results = []
+
+            # 1) Exact TMDb GUID match, whichever query it comes from
+            if tmdb_id is not None:
+                for r in results:
+                    rid = _result_tmdb_id(r)
+                    if rid and rid == tmdb_id:
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("Matched via TMDB GUID: %s (%s)", getattr(r, 'title', '?'), getattr(r, 'year', '?'))
+                        return r
+            # The GUID lookup only counts on an exact id hit; its results are not title
+            # candidates, so they are kept out of fuzzy ranking.
+            if queries[i] == guid_query:
+                guid_done = True
+                results = ()
+            completed[i] = results
+
+            # Similarity is evaluated in query order so the earliest strong match wins,
+            # regardless of which search happened to answer first.
+            while next_idx in completed:
+                results = completed.pop(next_idx)
+                next_idx += 1
+
+                # 2) Year + fuzzy title
+                filtered = []
+                if year:
+                    for r in results:
+                        ry = getattr(r, 'year', None)
+                        if isinstance(ry, int) and abs(ry - year) <= 1:
+                            filtered.append(r)
+                ranked = filtered or results
+
+                # keep the most similar title as a fallback candidate; the cutoff lets
+                # rapidfuzz reject candidates that cannot beat the current best early
+                top = process.extractOne(
+                    titles[0], [getattr(r, 'title', '') for r in ranked],
+                    scorer=fuzz.WRatio, processor=norm_title,
+                    score_cutoff=best_by_similarity[1] * 100,
+                )
+                if top and top[1] / 100.0 > best_by_similarity[1]:
+                    best_by_similarity = (ranked[top[2]], top[1] / 100.0)
+
+            # If we have a very strong match, take it
+            if guid_done and best_by_similarity[0] and best_by_similarity[1] >= 0.92:
+                return best_by_similarity[0]
+    finally:
+        # Drop searches that have not started yet so they don't hold workers
+        for future in futures:
+            future.cancel()
 
     # Fallback to the best we saw at all (if any)
     return best_by_similarity[0]
 
 def fetch_trending_data(url):
-    """Fetches trending data from TMDb."""
+    """Fetches trending data from TMDb, dropping duplicate and id-less records."""
     try:
         logger.debug(f"Fetching data from {url}")
-        response = requests.get(url)
+        params = None if TMDB_ACCESS_TOKEN else {'api_key': API_KEY}
+        response = SESSION.get(url, params=params, timeout=10)
         response.raise_for_status()
+        if getattr(response, 'revalidated', False):
+            logger.debug(f"TMDb returned 304 Not Modified for {url}; using cached body")
+        elif getattr(response, 'from_cache', False):
+            logger.debug(f"Using cached TMDb response for {url}")
         data = response.json()
-        logger.info(f"Fetched {len(data['results'])} items from TMDb")
-        return data['results']
+        seen, results = set(), []
+        for r in data['results']:
+            tid = r.get('id')
+            if tid and tid not in seen:
+                seen.add(tid); results.append(r)
+        dropped = len(data['results']) - len(results)
+        if dropped:
+            logger.debug(f"Dropped {dropped} duplicate or id-less TMDb records")
+        logger.info(f"Fetched {len(results)} items from TMDb")
+        return results
     except requests.RequestException as e:
         logger.error(f"Error fetching data from TMDb: {e}")
         raise
 
 def filter_items(items, date_key, days=365):
     """Filters items based on their date, returning those within the last 'days' days."""
-    cutoff_date = datetime.now() - timedelta(days=days)
-    filtered_items = [item for item in items if datetime.strptime(item[date_key], '%Y-%m-%d') >= cutoff_date][:10]
+    # TMDb dates are zero-padded YYYY-MM-DD, so string order matches date order.
+    # Items with a missing or empty date sort below any cutoff and are dropped.
+    cutoff_str = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    recent = (item for item in items if (item.get(date_key) or '') >= cutoff_str)
+    filtered_items = list(itertools.islice(recent, 10))
     logger.info(f"Filtered items: {len(filtered_items)} items within the last {days} days")
     return filtered_items
 
-def add_to_plex_watchlist(account, items):
-    """Adds items to the Plex watchlist."""
-    try:
-        account.addToWatchlist(items)
-        for item in items:
-            logger.info(f"Added {item.title} to Plex watchlist.")
-    except BadRequest as e:
-        logger.error(f"Error adding items to watchlist: {e}")
+def add_to_plex_watchlist(account, executor, items):
+    """
+    Adds items to the Plex watchlist.
+    plexapi's addToWatchlist issues a check and a PUT per item anyway, so items are added
+    one at a time on `executor`; a failure on one item no longer aborts the rest.
+    """
+    def add(item):
+        try:
+            account.addToWatchlist([item])
+        except Exception as e:
+            return e
+        return None
+
+    failed = 0
+    for item, error in zip(items, executor.map(add, items)):
+        if error is not None:
+            failed += 1
+            logger.error(f"Error adding {getattr(item, 'title', '?')} to watchlist: {error}")
+    logger.info(f"Added {len(items) - failed} of {len(items)} items to Plex watchlist.")
 
 def get_watchlist(account, libtype):
     """Retrieves the current watchlist items from Plex."""
@@ -208,84 +315,103 @@ def get_watchlist(account, libtype):
         logger.error(f"Error retrieving watchlist: {e}")
         return {}
 
-def process_media_items(trending_items, plex, account, media_type):
+def process_media_items(trending_items, account, executor, media_type, wl_signatures):
     """
     Build a list of Plex *catalog* items (not from your server) that correspond to TMDb trending items
     and are not already in your Plex watchlist.
     media_type: 'movie' or 'show'
+    executor: shared thread pool used for concurrent Discover searches
+    wl_signatures: (tmdb_ids, title_years) for media_type, as built by watchlist_cache()
     """
     items_to_add = []
-    tmdb_in_wl, titleyear_in_wl = watchlist_signatures(account, media_type)
+    # Per-entry outcomes are collected as raw tuples and logged once at the end;
+    # they are only formatted into text when DEBUG is enabled
+    excluded, untitled, already_in_wl, unmatched = [], [], [], []
+    tmdb_in_wl, titleyear_in_wl = wl_signatures
     logger.info(f"Processing {len(trending_items)} trending items for media type '{media_type}'")
 
     date_key = 'first_air_date' if media_type == 'show' else 'release_date'
 
     for entry in trending_items:
         if is_excluded_tmdb_item(entry):
-            logger.info(
-                f"Skipping excluded language/country item: "
-                f"{entry.get('title') or entry.get('name')} "
-                f"(lang={entry.get('original_language')}, "
-                f"country={entry.get('origin_country')})"
-            )
+            excluded.append((entry.get('title') or entry.get('name'), entry.get('original_language'), entry.get('origin_country')))
             continue
         tmdb_id = entry.get('id')
         year = year_from(entry.get(date_key, ''))
-        titles = titles_from_tmdb_item(entry)
+        titles, norm_titles = titles_from_tmdb_item(entry)
         if not titles:
-            logger.debug("No titles found in TMDb entry; skipping")
+            untitled.append(tmdb_id)
             continue
 
         # Skip if already in watchlist by TMDb id or title+year
         if tmdb_id and tmdb_id in tmdb_in_wl:
-            logger.info(f"{titles[0]} ({year}) already in watchlist; skipping")
+            already_in_wl.append((titles[0], year))
             continue
-        if year and any((norm_title(t), year) in titleyear_in_wl for t in titles):
-            logger.info(f"{titles[0]} ({year}) already in watchlist; skipping")
+        candidate_pairs = frozenset((nt, year) for nt in norm_titles) if year else frozenset()
+        if candidate_pairs and not titleyear_in_wl.isdisjoint(candidate_pairs):
+            already_in_wl.append((titles[0], year))
             continue
 
-        match = discover_best_match(account, media_type, titles, year, tmdb_id)
+        match = discover_best_match(account, executor, media_type, titles, year, tmdb_id)
         if not match:
-            logger.info(f"No Discover match for {titles[0]} ({year or 'n/a'})")
+            unmatched.append((titles[0], year))
             continue
 
         # extra safety: don't queue duplicates
         if match not in items_to_add:
             items_to_add.append(match)
-            logger.info(f"Queued '{getattr(match,'title','?')}' ({getattr(match,'year','?')}) for watchlist addition")
 
-    logger.info(f"Total new '{media_type}' items to add: {len(items_to_add)}")
+    logger.info(
+        "Summary for '%s': queued=%d excluded=%d untitled=%d duplicates=%d unmatched=%d",
+        media_type, len(items_to_add), len(excluded), len(untitled), len(already_in_wl), len(unmatched),
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "'%s' details: queued=%s excluded=%s untitled=%s duplicates=%s unmatched=%s",
+            media_type,
+            [f"{getattr(m, 'title', '?')} ({getattr(m, 'year', '?')})" for m in items_to_add],
+            [f"{t} (lang={lang}, country={country})" for t, lang, country in excluded],
+            [f"TMDb id {tid}" for tid in untitled],
+            [f"{t} ({y})" for t, y in already_in_wl],
+            [f"{t} ({y or 'n/a'})" for t, y in unmatched],
+        )
     return items_to_add
 
 
 def dynamic_watchlist():
     """Fetches, processes, and updates the Plex watchlist with trending items."""
     try:
-        # Fetch and filter trending TV shows and movies
         logger.info("Starting script execution")
-        top_tv_shows = filter_items(fetch_trending_data(TV_URL), 'first_air_date')
-        top_movies = filter_items(fetch_trending_data(MOVIE_URL), 'release_date')
-
-        # Log into Plex
-        logger.info("Logging into Plex")
-        account = MyPlexAccount(token=PLEX_TOKEN)
-        plex_server = PlexServer(PLEX_BASEURL, PLEX_TOKEN)
-
-        # Process and add TV shows and movies to watchlist
-        tv_shows_to_add = process_media_items(top_tv_shows, plex_server, account, 'show')
-        movies_to_add = process_media_items(top_movies, plex_server, account, 'movie')
-
-        all_items_to_add = tv_shows_to_add + movies_to_add
-
-        if all_items_to_add:
-            logger.info(f"Adding {len(all_items_to_add)} items to Plex watchlist")
-            add_to_plex_watchlist(account, all_items_to_add)
-            logger.info("Finished adding items to watchlist.")
-        else:
-            logger.info("No new items to add to the watchlist after processing and filtering.")
+        with ThreadPoolExecutor(max_workers=HTTP_WORKERS) as executor:
+            # Fetch (concurrently) and filter trending TV shows and movies
+            tv_future = executor.submit(fetch_trending_data, TV_URL)
+            movie_future = executor.submit(fetch_trending_data, MOVIE_URL)
+            top_tv_shows = filter_items(tv_future.result(), 'first_air_date')
+            top_movies = filter_items(movie_future.result(), 'release_date')
+
+            # Log into Plex
+            logger.info("Logging into Plex")
+            account = MyPlexAccount(token=PLEX_TOKEN)
+            wl_cache = watchlist_cache(account, executor)
+
+            # Process and add TV shows and movies to watchlist
+            tv_shows_to_add = process_media_items(top_tv_shows, account, executor, 'show', wl_cache['show'])
+            movies_to_add = process_media_items(top_movies, account, executor, 'movie', wl_cache['movie'])
+
+            all_items_to_add = tv_shows_to_add + movies_to_add
+
+            if all_items_to_add:
+                logger.info(f"Adding {len(all_items_to_add)} items to Plex watchlist")
+                add_to_plex_watchlist(account, executor, all_items_to_add)
+            else:
+                logger.info("No new items to add to the watchlist after processing and filtering.")
 
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
+    finally:
+        _discover.cache_clear()
+        if buffered_file_handler:
+            buffered_file_handler.flush()
 
 if __name__ == '__main__':
     dynamic_watchlist()